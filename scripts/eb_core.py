@@ -0,0 +1,265 @@
+"""Shared EB processing core: mapping, HL extraction, code resolution and output serialization"""
+import functools
+import json
+import os
+import re
+from datetime import datetime, timezone
+from typing import NamedTuple
+import orjson
+
+# Helper function to remove @ from all keys
+def remove_at_prefix(obj):
+    """Remove @ prefix from all dictionary keys in place, walking with a stack"""
+    # Parsed JSON is freshly allocated and never shared, so mutating is safe
+    stack = [obj]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if any(k.startswith("@") for k in node):
+                # Rebuild in place to keep the original key order
+                items = list(node.items())
+                node.clear()
+                for k, v in items:
+                    node[k.lstrip("@")] = v
+            stack.extend(v for v in node.values() if isinstance(v, (dict, list)))
+        elif isinstance(node, list):
+            stack.extend(v for v in node if isinstance(v, (dict, list)))
+    return obj
+
+# Lookup tables built from mapping.json
+class LookupCache(NamedTuple):
+    """Flat code lookup, mapped EB field names and the per-process key plan memo"""
+    code_lookup: dict  # "EB03\x00<code>" → description
+    known_fields: set  # EB fields that have a mapping
+    key_plans: dict  # EB entry key tuple → key plan, filled lazily
+
+# Lookup cache built by load_mapping (or handed to each pool worker)
+LOOKUP_CACHE = None
+
+def set_lookup_cache(lookup_cache):
+    """Install the lookup cache for this process and reset memoized code lookups"""
+    global LOOKUP_CACHE
+    LOOKUP_CACHE = lookup_cache
+    resolve_codes.cache_clear()
+
+# Load mapping file and build lookup cache
+def load_mapping():
+    """Load the EB code mappings from mapping.json and build lookup cache"""
+    with open("mapping.json", "rb") as f:
+        mapping = orjson.loads(f.read())
+    
+    # Pre-build a flat lookup cache keyed by "EB03\x00<code>" for faster access
+    # This needs one hash lookup per code instead of two nested ones
+    code_lookup = {
+        # Normalize code to string for consistent lookup
+        f"{eb_field}\x00{str(code)}": description
+        for eb_field, codes_dict in mapping.items()
+        for code, description in codes_dict.items()
+    }
+    known_fields = set(mapping)
+    
+    # Key plans are filled lazily by map_eb_codes, one per EB entry key set
+    key_plans = {}
+    
+    lookup_cache = LookupCache(code_lookup, known_fields, key_plans)
+    set_lookup_cache(lookup_cache)
+    return lookup_cache
+
+# Path from the document root to the HL3 (subscriber) loop
+HL3_PATH = ("ISA", "GS", "ST", "HL", "HL", "HL")
+
+# Walk nested dicts along a key path
+def walk_path(node, path):
+    """Follow path through nested dicts, returning None if any step is missing"""
+    for key in path:
+        if not isinstance(node, dict):
+            return None
+        node = node.get(key)
+    return node
+
+# Get member ID and EB data location (handle both HL3 and HL4) in one walk
+def get_member_and_eb_list(data):
+    """Extract patient member ID and EB list from JSON, handling both HL3 and HL4 structures"""
+    hl3 = walk_path(data, HL3_PATH)
+    if not isinstance(hl3, dict):
+        return None, None
+    
+    member_id = walk_path(hl3, ("NM1", "@NM109"))
+    
+    # Try HL4 structure first, then fall back to HL3 structure
+    eb_list = walk_path(hl3, ("HL", "EB"))
+    if eb_list is None:
+        eb_list = hl3.get("EB")
+    if not eb_list:
+        return member_id, eb_list
+    
+    # Ensure EB is a list
+    if isinstance(eb_list, dict):
+        eb_list = [eb_list]
+    
+    # Normalize MSG to a list here so map_eb_codes needs no special case
+    for eb_entry in eb_list:
+        if isinstance(eb_entry, dict):
+            msg = eb_entry.get("MSG")
+            if isinstance(msg, dict):
+                eb_entry["MSG"] = [msg]
+    return member_id, eb_list
+
+# Field kinds resolved once per key set when building a key plan
+FIELD_CODE = 0
+FIELD_OTHER = 1
+
+def get_key_plan(eb_entry, known_fields, key_plans):
+    """Return (key, clean_key, kind, prefix) tuples for the entry's keys, cached per key set"""
+    keys = tuple(eb_entry)
+    plan = key_plans.get(keys)
+    if plan is None:
+        # EB entries in a file share key sets, so all per-key decisions run once per shape
+        plan = []
+        for key in keys:
+            eb_field = key[1:]  # Remove @ prefix: "@EB03" → "EB03"
+            if key.startswith("@EB") and eb_field in known_fields:
+                plan.append((key, key.lstrip("@"), FIELD_CODE, eb_field + "\x00"))
+            else:
+                # Includes MSG and EB fields with no mapping available
+                plan.append((key, key.lstrip("@"), FIELD_OTHER, None))
+        key_plans[keys] = plan
+    return plan
+
+# Resolve an EB code value to its description, memoized across the whole run
+@functools.lru_cache(maxsize=65536)
+def resolve_codes(prefix, value_str):
+    """Map a single or multi-code EB value, keeping original codes if not found"""
+    code_lookup = LOOKUP_CACHE.code_lookup
+    
+    # Handle multi-code values (e.g., "UC^86")
+    if "^" in value_str:
+        # Single pass, stripping each code once
+        # Keep original code if not found in mapping
+        mapped_values = []
+        append = mapped_values.append
+        for code in value_str.split("^"):
+            code = code.strip()
+            append(code_lookup.get(prefix + code, code))
+        return ", ".join(mapped_values)
+    else:
+        # Single code value - direct lookup, keep original if not found
+        return code_lookup.get(prefix + value_str, value_str)
+
+# Map EB code values to their descriptions
+def map_eb_codes(eb_entry):
+    """Map EB codes to their descriptions using pre-built lookup cache"""
+    plan = get_key_plan(eb_entry, LOOKUP_CACHE.known_fields, LOOKUP_CACHE.key_plans)
+    mapped_entry = {}
+    
+    # Process all fields in the EB entry, ordered by the cached key plan
+    for key, clean_key, kind, prefix in plan:
+        value = eb_entry[key]
+        if kind == FIELD_CODE:
+            # Map EB codes using pre-built cache (code combos repeat heavily)
+            mapped_entry[clean_key] = resolve_codes(prefix, str(value).strip())
+        else:
+            # Keep other fields (MSG is already a list) as-is, but remove @ from all nested keys
+            mapped_entry[clean_key] = remove_at_prefix(value)
+    
+    # Every branch already strips @, so no second pass over mapped_entry
+    return mapped_entry
+
+# Serialize processed records for the output file
+def serialize_results(results, pretty=False):
+    """Build output file bytes, splicing in each record's pre-encoded data"""
+    if pretty:
+        # Pretty output is for reading by hand, so decoding data again is fine
+        records = [
+            {
+                "id": record["id"],
+                "member_id": record["member_id"],
+                "inserted_at": record["inserted_at"],
+                "data": orjson.loads(record["data_json"])
+            }
+            for record in results
+        ]
+        return orjson.dumps(records, option=orjson.OPT_INDENT_2 | orjson.OPT_UTC_Z)
+    
+    parts = []
+    for record in results:
+        header = orjson.dumps(
+            {
+                "id": record["id"],
+                "member_id": record["member_id"],
+                "inserted_at": record["inserted_at"]
+            },
+            option=orjson.OPT_UTC_Z
+        )
+        # Drop the closing brace and append data as the last key
+        parts.append(header[:-1] + b',"data":' + record["data_json"] + b"}")
+    return b"[" + b",".join(parts) + b"]"
+
+# orjson silently turns integers outside [-2**63, 2**64 - 1] into floats;
+# every such integer has at least 19 digits
+LONG_DIGIT_RUN = re.compile(rb"\d{19}")
+
+def check_int_width(token):
+    """Parse an integer token, rejecting values orjson cannot represent exactly"""
+    value = int(token)
+    if not -2**63 <= value <= 2**64 - 1:
+        raise ValueError(f"integer {token} is wider than 64 bits and would lose precision")
+    return value
+
+# Parse input JSON without silently corrupting wide integers
+def loads_json(raw):
+    """Parse raw JSON bytes with orjson, rejecting integers it would turn into floats"""
+    if LONG_DIGIT_RUN.search(raw):
+        # Rare slow path: stdlib json passes only real integer tokens (not strings) to parse_int
+        json.loads(raw, parse_int=check_int_width)
+    return orjson.loads(raw)
+
+# Process a single JSON file
+def process_json_file(file_path):
+    """Process a single JSON file and extract EB data"""
+    try:
+        with open(file_path, "rb") as f:
+            data = loads_json(f.read())
+        
+        member_id, eb_list = get_member_and_eb_list(data)
+        
+        if not eb_list:
+            print(f"⚠️ No EB data found in {os.path.basename(file_path)}")
+            return []
+        
+        # Process each EB entry
+        results = []
+        # orjson serializes datetimes natively (OPT_UTC_Z renders "Z")
+        timestamp = datetime.now(timezone.utc)
+        
+        for idx, eb_entry in enumerate(eb_list, 1):
+            if not isinstance(eb_entry, dict):
+                continue
+            
+            # Map codes using optimized lookup
+            mapped_data = map_eb_codes(eb_entry)
+            
+            # Create output record; data is encoded once, reused for DB and file
+            record = {
+                "id": idx,
+                "member_id": member_id,
+                "inserted_at": timestamp,
+                "data_json": orjson.dumps(mapped_data)
+            }
+            
+            results.append(record)
+        
+        return results
+    
+    except Exception as e:
+        print(f"❌ Error processing {os.path.basename(file_path)}: {str(e)}")
+        return []
+
+# Write a pre-built output buffer to disk
+def write_output_file(output_path, payload):
+    """Write payload with unbuffered I/O, normally in a single write() call"""
+    with open(output_path, "wb", buffering=0) as f:
+        view = memoryview(payload)
+        # Raw writes may be partial, so loop until everything is written
+        while view:
+            view = view[f.write(view):]
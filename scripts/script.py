@@ -1,44 +1,65 @@
-import json
+import atexit
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
+from queue import Queue
+from threading import Lock, Thread
 import psycopg2
-from psycopg2 import sql
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
+from eb_core import (
+    load_mapping,
+    process_json_file,
+    serialize_results,
+    set_lookup_cache,
+    write_output_file,
+)
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Output files are compact unless PRETTY=1 is set
+PRETTY_OUTPUT = os.getenv("PRETTY") == "1"
+
 # Setup logging file
 LOG_FILE = None
+LOG_HANDLE = None
+# The writer thread logs too, and TextIOWrapper is not thread-safe
+LOG_LOCK = Lock()
 
 def setup_log_file():
     """Setup pipeline_timestamp log file in logs folder with timestamp"""
-    global LOG_FILE
+    global LOG_FILE, LOG_HANDLE
     logs_folder = "../logs"
     os.makedirs(logs_folder, exist_ok=True)
     timestamp = datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
     LOG_FILE = os.path.join(logs_folder, f"pipeline_{timestamp}.log")
+    
+    # Open once and keep the handle; line buffering keeps the log tailable
+    try:
+        LOG_HANDLE = open(LOG_FILE, "a", buffering=1)
+        atexit.register(LOG_HANDLE.close)
+    except Exception as e:
+        print(f"❌ Error opening log file: {e}")
     return LOG_FILE
 
 def log_message(message):
     """Append message to pipeline_timestamp log file"""
-    global LOG_FILE
-    if LOG_FILE:
+    if LOG_HANDLE:
         try:
-            with open(LOG_FILE, "a") as f:
-                f.write(message + "\n")
+            with LOG_LOCK:
+                LOG_HANDLE.write(message + "\n")
         except Exception as e:
             print(f"❌ Error writing to log file: {e}")
 
-def log_line_break():
-    """Add a line break to the log file"""
-    global LOG_FILE
-    if LOG_FILE:
+def log_block(messages):
+    """Append messages and a line break as one block, so other threads can't split it"""
+    if LOG_HANDLE:
         try:
-            with open(LOG_FILE, "a") as f:
-                f.write("\n")
+            with LOG_LOCK:
+                LOG_HANDLE.write("".join(message + "\n" for message in messages) + "\n")
         except Exception as e:
             print(f"❌ Error writing to log file: {e}")
 
@@ -59,106 +80,6 @@ def connect_to_db():
         print(f"❌ Error connecting to database: {error}")
         return None
 
-# Helper function to recursively remove @ from all keys
-def remove_at_prefix(obj):
-    """Recursively remove @ prefix from all dictionary keys"""
-    if isinstance(obj, dict):
-        return {k.lstrip("@"): remove_at_prefix(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [remove_at_prefix(item) for item in obj]
-    else:
-        return obj
-
-# Load mapping file and build lookup cache
-def load_mapping():
-    """Load the EB code mappings from mapping.json and build lookup cache"""
-    with open("mapping.json", "r") as f:
-        mapping = json.load(f)
-    
-    # Pre-build lookup cache for faster access
-    # This avoids repeated dictionary lookups during processing
-    lookup_cache = {}
-    for eb_field, codes_dict in mapping.items():
-        lookup_cache[eb_field] = {}
-        for code, description in codes_dict.items():
-            # Normalize code to string for consistent lookup
-            lookup_cache[eb_field][str(code)] = description
-    
-    return lookup_cache
-
-# Extract member ID and payer info from JSON
-def extract_patient_info(data):
-    """Extract patient member ID and payer info from the JSON structure"""
-    try:
-        member_id = data["ISA"]["GS"]["ST"]["HL"]["HL"]["HL"]["NM1"]["@NM109"]
-        return member_id
-    except KeyError:
-        return None
-
-# Get EB data location (handle both HL3 and HL4)
-def get_eb_list(data):
-    """Extract EB list from JSON, handling both HL3 and HL4 structures"""
-    try:
-        # Try HL4 structure first
-        eb_list = data["ISA"]["GS"]["ST"]["HL"]["HL"]["HL"]["HL"]["EB"]
-        return eb_list
-    except (KeyError, TypeError):
-        try:
-            # Fall back to HL3 structure
-            eb_list = data["ISA"]["GS"]["ST"]["HL"]["HL"]["HL"]["EB"]
-            return eb_list
-        except (KeyError, TypeError):
-            return None
-
-# Map EB code values to their descriptions
-def map_eb_codes(eb_entry, lookup_cache):
-    """Map EB codes to their descriptions using pre-built lookup cache"""
-    mapped_entry = {}
-    
-    # Process all fields in the EB entry
-    for key, value in eb_entry.items():
-        if key == "MSG":
-            # Keep MSG as-is (convert dict to list if needed)
-            if isinstance(value, list):
-                mapped_entry[key] = value
-            elif isinstance(value, dict):
-                mapped_entry[key] = [value]
-            else:
-                mapped_entry[key] = value
-        elif key.startswith("@EB"):
-            # Map EB codes using pre-built cache
-            eb_field = key[1:]  # Remove @ prefix: "@EB03" → "EB03"
-            clean_key = key.lstrip("@")  # Remove @ for output key
-            
-            # Check if this EB field has mappings
-            if eb_field not in lookup_cache:
-                # No mapping available, keep original value
-                mapped_entry[clean_key] = value
-                continue
-            
-            field_mapping = lookup_cache[eb_field]
-            value_str = str(value).strip()
-            
-            # Handle multi-code values (e.g., "UC^86")
-            if "^" in value_str:
-                codes = value_str.split("^")
-                # Use list comprehension for better performance
-                # Keep original code if not found in mapping
-                mapped_values = [
-                    field_mapping.get(code.strip(), code.strip()) 
-                    for code in codes
-                ]
-                mapped_entry[clean_key] = ", ".join(mapped_values)
-            else:
-                # Single code value - direct lookup, keep original if not found
-                mapped_entry[clean_key] = field_mapping.get(value_str, value_str)
-        else:
-            # Keep other fields as-is, but remove @ from all nested keys
-            mapped_entry[key] = remove_at_prefix(value)
-    
-    # Finally, remove @ prefix from all remaining keys
-    return remove_at_prefix(mapped_entry)
-
 # Insert data into database
 def insert_into_db(conn, member_id, data_records):
     """Insert processed EB records into eb_blocks table"""
@@ -167,14 +88,21 @@ def insert_into_db(conn, member_id, data_records):
     
     try:
         cursor = conn.cursor()
-        inserted_count = 0
         
-        for record in data_records:
-            insert_query = sql.SQL(
-                "INSERT INTO eb_blocks (member_id, data) VALUES (%s, %s)"
-            )
-            cursor.execute(insert_query, (member_id, json.dumps(record["data"])))
-            inserted_count += 1
+        # Send all records for this file in one batched INSERT
+        # Multi-row VALUES is parsed and planned once per page; a PREPARE'd
+        # single-row statement would instead run once per row
+        rows = [
+            (member_id, record["data_json"].decode())
+            for record in data_records
+        ]
+        execute_values(
+            cursor,
+            "INSERT INTO eb_blocks (member_id, data) VALUES %s",
+            rows,
+            page_size=500
+        )
+        inserted_count = len(rows)
         
         conn.commit()
         cursor.close()
@@ -186,50 +114,48 @@ def insert_into_db(conn, member_id, data_records):
             conn.rollback()
         return 0
 
-# Process a single JSON file
-def process_json_file(file_path, lookup_cache):
-    """Process a single JSON file and extract EB data"""
-    try:
-        with open(file_path, "r") as f:
-            data = json.load(f)
-        
-        member_id = extract_patient_info(data)
-        eb_list = get_eb_list(data)
-        
-        if not eb_list:
-            print(f"⚠️ No EB data found in {os.path.basename(file_path)}")
-            return []
-        
-        # Ensure EB is a list
-        if isinstance(eb_list, dict):
-            eb_list = [eb_list]
-        
-        # Process each EB entry
-        results = []
-        timestamp = datetime.utcnow().isoformat() + "Z"
-        
-        for idx, eb_entry in enumerate(eb_list, 1):
-            if not isinstance(eb_entry, dict):
-                continue
-            
-            # Map codes using optimized lookup
-            mapped_data = map_eb_codes(eb_entry, lookup_cache)
-            
-            # Create output record
-            record = {
-                "id": idx,
-                "member_id": member_id,
-                "inserted_at": timestamp,
-                "data": mapped_data
-            }
-            
-            results.append(record)
-        
-        return results
+# Insert, log and save the results of one processed file
+def save_results(conn, source_file, output_path, results, write_queue=None):
+    """Insert results into the DB and save the output, inline or via the writer thread"""
+    # Insert into database
+    member_id = results[0].get("member_id")
+    db_inserted = insert_into_db(conn, member_id, results)
     
-    except Exception as e:
-        print(f"❌ Error processing {os.path.basename(file_path)}: {str(e)}")
-        return []
+    output_filename = os.path.basename(output_path)
+    payload = serialize_results(results, pretty=PRETTY_OUTPUT)
+    if write_queue is None:
+        write_output_file(output_path, payload)
+        log_msg_1 = f"✅ Saved: {output_filename} ({len(results)} EB records)"
+    else:
+        log_msg_1 = f"✅ Queued: {output_filename} ({len(results)} EB records)"
+    log_msg_2 = f"✅ Inserted into DB: {db_inserted} records"
+    
+    print(log_msg_1)
+    print(log_msg_2)
+    # Log the whole block before queueing, so "Saved" always follows it
+    log_block([f"Processing: {source_file}", log_msg_1, log_msg_2])
+    
+    if write_queue is not None:
+        # Hand output to the writer thread, which logs once it is saved
+        write_queue.put((output_path, payload, len(results)))
+    return db_inserted
+
+# Write output files in the background so disk writes overlap processing
+def write_output_files(write_queue):
+    """Write (output_path, payload, record_count) items from the queue until None is received"""
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        output_path, payload, record_count = item
+        output_filename = os.path.basename(output_path)
+        try:
+            write_output_file(output_path, payload)
+            log_msg = f"✅ Saved: {output_filename} ({record_count} EB records)"
+        except Exception as e:
+            log_msg = f"❌ Error writing {output_filename}: {str(e)}"
+        print(log_msg)
+        log_message(log_msg)
 
 # Main processing function
 def main():
@@ -256,46 +182,55 @@ def main():
     # Create output folder if it doesn't exist
     os.makedirs(output_folder, exist_ok=True)
     
-    # Get all JSON files
-    json_files = [f for f in os.listdir(data_folder) if f.endswith(".json")]
+    # Get all JSON files (DirEntry type checks and stats avoid extra syscalls)
+    with os.scandir(data_folder) as it:
+        entries = [e for e in it if e.name.endswith(".json") and e.is_file()]
+    
+    # Largest files first so long-running work starts early in the pool
+    entries.sort(key=lambda e: e.stat().st_size, reverse=True)
+    json_files = [e.name for e in entries]
     
     print(f"Found {len(json_files)} JSON files to process\n")
     
     total_db_records = 0
+    file_paths = [e.path for e in entries]
     
-    # Process each file
-    for json_file in json_files:
-        file_path = os.path.join(data_folder, json_file)
-        print(f"Processing: {json_file}")
-        log_message(f"Processing: {json_file}")
+    # Parse and map files in parallel; DB inserts and file writes stay here
+    with ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        # Install the lookup cache once per worker rather than pickling it per task
+        initializer=set_lookup_cache,
+        initargs=(lookup_cache,)
+    ) as executor:
+        # One file per task, so the largest files really run first on separate workers
+        all_results = executor.map(process_json_file, file_paths, chunksize=1)
         
-        # Extract member ID from filename for reference
-        results = process_json_file(file_path, lookup_cache)
+        # Start the writer only after the work is submitted, so the pool has
+        # already forked its workers from a single-threaded parent
+        # Bounded queue keeps at most a few serialized files waiting in memory
+        write_queue = Queue(maxsize=8)
+        writer = Thread(target=write_output_files, args=(write_queue,))
+        writer.start()
         
-        if results:
-            # Insert into database
-            member_id = results[0].get("member_id")
-            db_inserted = insert_into_db(conn, member_id, results)
-            total_db_records += db_inserted
-            
-            # Create output filename
-            output_filename = f"{json_file.replace('.json', '')}_processed.json"
-            output_path = os.path.join(output_folder, output_filename)
-            
-            # Write output
-            with open(output_path, "w") as f:
-                json.dump(results, f, indent=2)
-            
-            log_msg_1 = f"✅ Saved: {output_filename} ({len(results)} EB records)"
-            log_msg_2 = f"✅ Inserted into DB: {db_inserted} records"
-            
-            print(log_msg_1)
-            print(log_msg_2)
-            log_message(log_msg_1)
-            log_message(log_msg_2)
-            log_line_break()
-        else:
-            print(f"⚠️ No data extracted from {json_file}\n")
+        try:
+            for json_file, results in zip(json_files, all_results):
+                print(f"Processing: {json_file}")
+                
+                if results:
+                    # Create output filename
+                    output_filename = f"{json_file.replace('.json', '')}_processed.json"
+                    output_path = os.path.join(output_folder, output_filename)
+                    
+                    total_db_records += save_results(
+                        conn, json_file, output_path, results, write_queue
+                    )
+                else:
+                    log_message(f"Processing: {json_file}")
+                    print(f"⚠️ No data extracted from {json_file}\n")
+        finally:
+            # Always flush queued output files, even if the pool fails
+            write_queue.put(None)
+            writer.join()
     
     print(f"📊 Processing complete! Total DB records inserted: {total_db_records}")
     conn.close()
@@ -330,36 +265,22 @@ if __name__ == "__main__":
         
         # Load mapping and process single file
         print(f"Loading and building mapping cache...")
-        lookup_cache = load_mapping()
+        load_mapping()
         
         print(f"\nProcessing single file: {specific_file}")
-        log_message(f"Processing: {specific_file}")
         
-        results = process_json_file(file_path, lookup_cache)
+        results = process_json_file(file_path)
         
         if results:
-            # Insert into database
-            member_id = results[0].get("member_id")
-            db_inserted = insert_into_db(conn, member_id, results)
-            
             # Create output filename
             output_filename = f"{specific_file.replace('.json', '')}.json"
             output_path = os.path.join(output_folder, output_filename)
             
-            # Write output
-            with open(output_path, "w") as f:
-                json.dump(results, f, indent=2)
-            
-            log_msg_1 = f"✅ Saved: {output_filename} ({len(results)} EB records)"
-            log_msg_2 = f"✅ Inserted into DB: {db_inserted} records"
-            
+            # Single file: nothing to overlap with, so write inline
+            save_results(conn, specific_file, output_path, results)
             print(f"✅ Successfully processed: {specific_file}")
-            print(log_msg_1)
-            print(log_msg_2)
-            log_message(log_msg_1)
-            log_message(log_msg_2)
-            log_line_break()
         else:
+            log_message(f"Processing: {specific_file}")
             print(f"⚠️ No data extracted from {specific_file}")
         
         conn.close()